@@ -1,8 +1,15 @@
 from math import log2, floor
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Union
+import logging
 import numpy as np
 import cv2
 import os
 
+logger = logging.getLogger(__name__)
+
+_DEFAULT_PIXEL_M = 0.000264583333337192  # default length of a projector pixel in metres
+
 
 class Projector:
     def __init__(self, position: np.ndarray, angle: float, projector_resolution: np.ndarray, accuracy=0.5,
@@ -14,7 +21,8 @@ class Projector:
                 Oz is directed to an object from the camera (right-handed coordinate system).
                 The center of a coordinate system is in the camera focus.
         :param angle:[0, 90]: Angle related to the camera.
-        :param projector_resolution: np.array([h, w]): Resolution of projector in pixels (etc. 1024x768).
+        :param projector_resolution: np.array([w, h]): Resolution of projector in pixels (etc. 1024x768).
+                Stripe images are generated row-major with shape (h, w).
         :param accuracy:[0...1]: Shows how many stripes will be according to resolution in the last image.
         :param directory: Directory to store stripe images.
         """
@@ -27,10 +35,26 @@ class Projector:
         self.image_count = self.FindImageCount(accuracy)
         self.stripe_count = 2 ** self.image_count  # count of stripes in the last image
 
-        self.stripes_order = self.StripeArray()  # np.array(log2(count), count-1) with order of stripes in iterations
-        self.strip_width = self.width // self.stripe_count
+        self.stripes_order = self.StripeArray()  # np.array(log2(count), count) with order of stripes in iterations
+        # stripe_count is a power of 2, so division and remainder are a shift and a mask
+        self.strip_width = self.width >> self.image_count
         # the last strip has a calculation error of stripe_width
-        self.last_stripe_width = self.strip_width + self.width % self.stripe_count
+        self.last_stripe_width = self.strip_width + (self.width & (self.stripe_count - 1))
+
+        # x coordinates (in pixels) of the start of each stripe and widths of stripes
+        self._x0 = np.arange(self.stripe_count, dtype=np.int32) * np.int32(self.strip_width)
+        self._w = np.full(self.stripe_count, self.strip_width, dtype=np.int32)
+        self._w[-1] = self.last_stripe_width
+
+        # np.array(log2(count), width) with the value of each image column in iterations
+        self._col_masks = np.repeat(self.stripes_order, self._w, axis=1)
+
+        # code word of each stripe is its column of stripes_order, the bit of the first image is the most significant
+        bit_shifts = np.arange(self.image_count - 1, -1, -1)[:, np.newaxis]
+        codes = (self.stripes_order.astype(np.int64) << bit_shifts).sum(axis=0)
+        # stripe numbers indexed by a code word which a camera pixel reads across all images
+        self._code_to_stripe = np.empty(self.stripe_count, dtype=np.min_scalar_type(self.stripe_count - 1))
+        self._code_to_stripe[codes] = np.arange(self.stripe_count)
 
         self.image_index = 0  # index of last generated image
 
@@ -39,10 +63,14 @@ class Projector:
                 which is not far away from the projector.
             It is also possible to use default value.
         '''
-        self.pixel_in_meters = 0.000264583333337192  # length of a pixel in metres
+        self.pixel_in_meters = _DEFAULT_PIXEL_M  # length of a pixel in metres
         self.test_distance = None  # distance for a screen with a test projection
+        self._planes = None  # np.array(stripe_count, 4) with plane parameters, calculated on first request
+        self._planes_key = None  # geometry which the cached planes were calculated for
 
         self.directory = directory
+        self._io = None  # writes stripe images in the background, it is started by SaveImages
+        self._writes = set()  # futures of stripe images which are being written or failed, checked in close()
 
     def FindImageCount(self, accuracy: float) -> int:
         """
@@ -57,25 +85,37 @@ class Projector:
         needed_count = floor(max_count * accuracy)
         return needed_count
 
-    def StripeArray(self) -> np.array:
+    def StripeArray(self) -> np.ndarray:
         """
         Create a np.array() of stripes order for each iteration.
+        Stripes are coded with reflected Gray code, so neighbouring stripes differ only in one image.
 
-        :return: np.array(), shape=(log2(stripe_count), stripe_count - 1):
+        :return: np.array(dtype=np.uint8), shape=(log2(stripe_count), stripe_count):
                 A line number is number of an image and a column number is number of each stipe.
                 So (i, j) element shows if in an i-iteration a j-stripe is shown or not
         """
+        stripe_numbers = np.arange(self.stripe_count, dtype=np.uint32)
+        # big-endian uint32 keeps the most significant bit first after unpacking on any platform
+        gray_codes = (stripe_numbers ^ (stripe_numbers >> 1)).astype('>u4')
+        bits = np.unpackbits(gray_codes.view(np.uint8).reshape(self.stripe_count, 4), axis=1)
 
-        image_count_str = '0' + str(self.image_count + 2) + 'b'
-        bins = [format(i, image_count_str)[2:] for i in range(self.stripe_count)]  # array of bin numbers,
-        # preparation for result array
+        # the last image_count bits of a stripe code are its column in the result array
+        stripe_array = np.ascontiguousarray(bits[:, 32 - self.image_count:].T)
+        return stripe_array
 
-        stripe_array = np.zeros((self.image_count, self.stripe_count), dtype=int)
+    def DecodeStripe(self, code: Union[int, np.ndarray]) -> Union[int, np.ndarray]:
+        """
+        Find a stripe number by its code word.
 
-        for i in range(self.stripe_count):
-            stripe_array[..., i] = np.array([int(j) for j in bins[i]]).T
-        print(stripe_array)
-        return stripe_array
+        :param code: int or np.array() of ints: Code word which is read across all images,
+                the bit of the first image is the most significant.
+        :return: Number of a stripe (or np.array(dtype=np.intp) of numbers) which is used in GetPlaneEquation.
+        """
+        stripes = self._code_to_stripe[code]
+        # the table is stored in a small unsigned type, signed numbers do not wrap around in arithmetic
+        if np.ndim(stripes) == 0:
+            return int(stripes)
+        return stripes.astype(np.intp)
 
     def SetTestProjection(self, distance: float, width: float) -> None:
         """
@@ -89,62 +129,150 @@ class Projector:
         self.test_distance = distance
         self.pixel_in_meters = width / self.width
 
-    def GenerateImage(self) -> np.array:
+    def GenerateImage(self) -> np.ndarray:
         """
         Create an image for current stripe order
 
-        :return: Desired image
+        :return: Desired image, np.array(dtype=np.uint8), shape=(height, width).
+                 It is a read-only view, so copy it before changing.
         """
-        image = np.zeros((self.width, self.height))
-        stripes = np.where(self.stripes_order[self.image_index] == 1)[0]  # indexes of stripes which are on
-        for stripe in stripes:
-            x0 = self.strip_width * stripe  # coordinate of the start of a stripe
-            image[:, x0:x0 + self.strip_width] = 1
+        image = np.broadcast_to(self._col_masks[self.image_index], (self.height, self.width))
 
         self.image_index += 1
         return image
 
-    def GetPlaneEquation(self, stripe_number: int) -> np.array:
+    def GenerateAllImages(self) -> np.ndarray:
         """
-        Create a np.array() with plane parameters a,b,c,d of the stripe.
+        Create images for every stripe order at once. It does not change the index of last generated image.
+
+        :return: Desired images, np.array(dtype=np.uint8), shape=(image_count, height, width).
+                 It is a read-only view, so copy it before changing.
+        """
+        return np.broadcast_to(self._col_masks[:, np.newaxis, :], (self.image_count, self.height, self.width))
+
+    def SaveImages(self) -> list:
+        """
+        Write images for every stripe order to the directory as '<image index>-image.png' in the background.
+        Call close() or wait on the returned futures to be sure that all of them are written.
+
+        :return: list of concurrent.futures.Future, one for each image. A future raises OSError if its image
+                 was not written.
+        """
+        if self._io is None:
+            self._io = ThreadPoolExecutor(max_workers=2)
+
+        os.makedirs(self.directory, exist_ok=True)
+        writes = []
+        for index, mask in enumerate(self._col_masks):
+            image = np.tile(mask * np.uint8(255), (self.height, 1))  # cv2 needs a contiguous 8-bit image
+            path = os.path.join(self.directory, '{0}-image.png'.format(index))
+            write = self._io.submit(self._WriteImage, path, image)
+            self._writes.add(write)
+            write.add_done_callback(self._ForgetWrite)
+            writes.append(write)
+
+        return writes
+
+    def _ForgetWrite(self, write: Future) -> None:
+        """
+        Stop tracking a finished write, failed writes are kept to be raised in close().
+
+        :param write: Future of a stripe image write.
+        :return: None
+        """
+        if write.cancelled() or write.exception() is None:
+            self._writes.discard(write)
+
+    @staticmethod
+    def _WriteImage(path: str, image: np.ndarray) -> None:
+        """
+        Write an image as png, cv2 reports a failure only by the returned value.
+
+        :param path: Path of the image file.
+        :param image: np.array(dtype=np.uint8), shape=(height, width).
+        :return: None
+        """
+        if not cv2.imwrite(path, image, [cv2.IMWRITE_PNG_COMPRESSION, 1]):
+            raise OSError('Could not write an image to {0}'.format(path))
+
+    def close(self) -> None:
+        """
+        Wait until all stripe images are written and stop the background writer.
+        SaveImages starts a new one if it is called again.
+
+        :return: None
+        """
+        if self._io is not None:
+            self._io.shutdown(wait=True)
+            self._io = None
+
+        writes, self._writes = self._writes, set()
+        for write in writes:
+            write.result()  # raise an error of a failed write
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def GetAllPlaneEquations(self) -> np.ndarray:
+        """
+        Create a np.array() with plane parameters a,b,c,d of every stripe.
         To avoid calculation of planes for each pixel of a stripe it calculates only for middle pixel.
         Equation is calculated by 3 points which belong to a plane.
 
-        :param stripe_number: number of a stripe which plate is calculating
-        :return: np.array([a, b, c, d])
-                 where a, b, c, d are parameters of plane
+        :return: np.array(), shape=(stripe_count, 4):
+                 A line number is number of a stripe and the line is [a, b, c, d] parameters of its plane.
+                 The array is cached and read-only, it is recalculated when position, angle,
+                 pixel_in_meters or test_distance change.
         """
-        width = self.strip_width
-        if stripe_number == self.stripe_count - 1:
-            width = self.last_stripe_width
+        planes_key = (np.asarray(self.position).tobytes(), self.angle, self.pixel_in_meters, self.test_distance)
+        if self._planes is not None and planes_key == self._planes_key:
+            return self._planes
 
-        # x coordinate (in pixels) of the middle pixel in a stripe
-        middle_stripe_pixel = (stripe_number - 1) * self.strip_width + width // 2
+        # x coordinates (in pixels) of the middle pixel in each stripe
+        middle_stripe_pixels = self._x0 - self.strip_width + self._w // 2
         central_image_pixel = self.width // 2  # x coordinate (in pixels) of the central pixel in an image
 
-        delta_pixel = middle_stripe_pixel - central_image_pixel  # pixel shift
-        delta_pixel *= self.pixel_in_meters  # shift in meters
-        delta_angel = self.angle - np.arctan(delta_pixel / self.test_distance)  # angle shift
+        delta_pixels = (middle_stripe_pixels - central_image_pixel) * self.pixel_in_meters  # shifts in meters
 
-        x = self.test_distance * np.cos(self.angle - delta_angel)
-        y = self.position[1]
-        z = self.test_distance * np.sin(self.angle - delta_angel)
+        # the middle pixel is seen at atan(delta / distance), cos and sin of it are expressed without trigonometry
+        ray_lengths = np.hypot(self.test_distance, delta_pixels)
+        x = self.test_distance * self.test_distance / ray_lengths
+        y = np.full(self.stripe_count, self.position[1])
+        z = self.test_distance * delta_pixels / ray_lengths
 
         point1 = self.position
-        point2 = np.array([x, y, z])
-        point3 = np.array([x, y + 1, z])
+        points2 = np.stack((x, y, z), axis=1)
+        points3 = points2 + np.array([0, 1, 0])
 
-        # these two vectors are in the plane
-        v1 = point3 - point1
-        v2 = point2 - point1
+        # these two vectors are in each plane
+        v1 = points3 - point1
+        v2 = points2 - point1
 
-        # the cross product is a vector normal to the plane
+        # the cross products are vectors normal to the planes
         cp = np.cross(v1, v2)
-        a, b, c = cp
 
-        # this evaluates a * x3 + b * y3 + c * z3 which equals d
-        d = np.dot(cp, point3)
+        # this evaluates a * x3 + b * y3 + c * z3 which equals d for each plane
+        d = np.einsum('ij,ij->i', cp, points3)
+
+        self._planes = np.column_stack((cp, d))
+        self._planes.flags.writeable = False
+        self._planes_key = planes_key
+        return self._planes
+
+    def GetPlaneEquation(self, stripe_number: int) -> np.ndarray:
+        """
+        Create a np.array() with plane parameters a,b,c,d of the stripe.
+
+        :param stripe_number: number of a stripe which plate is calculating
+        :return: np.array([a, b, c, d])
+                 where a, b, c, d are parameters of plane
+        """
+        plane = self.GetAllPlaneEquations()[stripe_number].copy()
 
-        print('The equation is {0}x + {1}y + {2}z = {3}'.format(a, b, c, d))
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('The equation is {0}x + {1}y + {2}z = {3}'.format(*plane))
 
-        return np.array([a, b, c, d])
+        return plane